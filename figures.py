@@ -1,82 +1,173 @@
-import plotly.graph_objects as go
+import plotly.io as pio
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
+from cachetools import TTLCache
 import os
-import json
+import orjson
 from datetime import timedelta, datetime
 import pandas as pd
 
-def generate_aqi_figure(current_dt, latitude, longitude):
-    # retrieve AQI history, current conditions, and forecast, then generate figure and return results
+# Figures are built as plain dicts to skip plotly's per-property validation; the default template is resolved once
+_TEMPLATE = pio.templates[pio.templates.default].to_plotly_json()
+# Dash serializes figures through plotly.io.json, so pin it to the orjson engine. The x values are datetime64[s] arrays so plotly
+# formats them with one vectorized np.datetime_as_string call instead of converting each element to a Python datetime;
+# only the numeric y arrays reach orjson as numpy arrays.
+pio.json.config.default_engine = 'orjson'
+
+# API keys and endpoints are read once at import time
+_MAPS_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
+_AQI_URLS = {endpoint: f'https://airquality.googleapis.com/v1/{endpoint}:lookup?key={_MAPS_KEY}' for endpoint in ('forecast', 'currentConditions', 'history')}
+
+# Persistent HTTP sessions so TCP/TLS handshakes are amortized across page loads
+_RETRY_STATUSES = [429, 500, 502, 503, 504]
+_weather_session = requests.Session()
+_weather_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=_RETRY_STATUSES)))
+_aqi_session = None
+
+def _get_aqi_session():
+    # Lazily open the pooled AQI session on the shared event loop and keep it alive between requests
+    global _aqi_session
+    if _aqi_session is None or _aqi_session.closed:
+        _aqi_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(sock_connect=3, sock_read=10)
+        )
+    return _aqi_session
+
+async def _post_json(session, url, data, retries=3, backoff_factor=0.2):
+    # POST to an AQI endpoint, retrying transient failures (429/5xx, dropped keep-alive sockets, timeouts) with exponential
+    # backoff. Bodies are (de)serialized with orjson.
+    body = orjson.dumps(data)
+    for attempt in range(retries + 1):
+        try:
+            async with session.post(url, headers={'Content-Type': 'application/json'}, data=body) as response:
+                if response.status not in _RETRY_STATUSES or attempt == retries:
+                    return orjson.loads(await response.read())
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+        await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+# AQI lookups are cached per ~1 km cell (coordinates rounded to 2 decimals). History and forecast update hourly,
+# current conditions more often. The caches are only touched from the shared event loop, so they need no lock.
+_hourly_aqi_cache = TTLCache(maxsize=512, ttl=3600)
+_current_aqi_cache = TTLCache(maxsize=512, ttl=600)
+
+async def _cached_lookup(cache, key, fetch, *args):
+    # Serve an AQI lookup from cache, otherwise fetch it and store the result
+    if key in cache:
+        return cache[key]
+    result = await fetch(*args)
+    cache[key] = result
+    return result
+
+
+async def _fetch_history(session, latitude, longitude):
+    # Retrieve historical AQI
+    history = {}
+    data = {
+        "hours": 720,
+        "pageSize": 720,
+        "location": {
+            "latitude": latitude,
+            "longitude": longitude
+        }
+    }
+    while True: # A while loop to handle pagination
+        body = await _post_json(session, _AQI_URLS['history'], data)
+        for hourly_result in body['hoursInfo']:
+            if 'dateTime' in hourly_result and 'indexes' in hourly_result: history.update({hourly_result['dateTime']: hourly_result['indexes'][0]['aqi']})
+        if 'nextPageToken' in body:
+            data.update({'pageToken': body['nextPageToken']})
+        else:
+            break
+    return history
+
+async def _fetch_current(session, latitude, longitude):
+    # Retrieve current AQI
+    data = {
+        "location": {
+            "latitude": latitude,
+            "longitude": longitude
+        }
+    }
+    body = await _post_json(session, _AQI_URLS['currentConditions'], data)
+    return {body['dateTime']: body['indexes'][0]['aqi']}
+
+async def _fetch_forecast(session, current_dt, latitude, longitude):
+    # Retrieve forecasted AQI
+    forecast = {}
+    data = {
+        "universalAqi": "true",
+        "location": {
+            "latitude": latitude,
+            "longitude": longitude
+        },
+        "period": {
+            "startTime": (current_dt + timedelta(hours=1)).strftime(format='%Y-%m-%dT%H:%M:%SZ'),
+            "endTime": (current_dt + timedelta(hours=96)).strftime(format='%Y-%m-%dT%H:%M:%SZ')
+        },
+    }
+    while True: # A while loop to handle pagination
+        body = await _post_json(session, _AQI_URLS['forecast'], data)
+        for hourly_forecast in body['hourlyForecasts']:
+            forecast.update({hourly_forecast['dateTime']: hourly_forecast['indexes'][0]['aqi']})
+        if 'nextPageToken' in body:
+            data.update({'pageToken': body['nextPageToken']})
+        else:
+            break
+    return forecast
+
+async def fetch_aqi(current_dt, latitude, longitude):
+    # retrieve AQI forecast, current conditions, and history concurrently over one pooled session
+    session = _get_aqi_session()
+    latitude, longitude = round(latitude, 2), round(longitude, 2)
+    hour_bucket = current_dt.strftime('%Y-%m-%dT%H')
+    forecast, current, history = await asyncio.gather(
+        _cached_lookup(_hourly_aqi_cache, ('forecast', latitude, longitude, hour_bucket), _fetch_forecast, session, current_dt, latitude, longitude),
+        _cached_lookup(_current_aqi_cache, (latitude, longitude), _fetch_current, session, latitude, longitude),
+        _cached_lookup(_hourly_aqi_cache, ('history', latitude, longitude, hour_bucket), _fetch_history, session, latitude, longitude),
+    )
+    # Merge in the original lookup order so history takes precedence on overlapping timestamps
     aqi_results = {}
-    for time in ['forecast', 'currentConditions', 'history']:
-        url = f'https://airquality.googleapis.com/v1/{time}:lookup?key={os.getenv('GOOGLE_MAPS_API_KEY')}'
-        match time:
-            case 'history': # Retrieve historical AQI
-                data = {
-                        "hours": 720,
-                        "pageSize": 720,
-                        "location": {
-                            "latitude": latitude,
-                            "longitude": longitude
-                        }
-                    }
-                while True: # A while loop to handle pagination
-                    response = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
-                    for hourly_result in response.json()['hoursInfo']:
-                        if 'dateTime' in hourly_result and 'indexes' in hourly_result: aqi_results.update({hourly_result['dateTime']: hourly_result['indexes'][0]['aqi']})
-                    if 'nextPageToken' in response.json():
-                        data.update({'pageToken': response.json()['nextPageToken']})
-                    else:
-                        break
-            case 'currentConditions': # Retrieve current AQI
-                data = {
-                    "location": {
-                        "latitude": latitude,
-                        "longitude": longitude
-                    }
-                }
-                response = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
-                aqi_results.update({response.json()['dateTime']: response.json()['indexes'][0]['aqi']})
-            case 'forecast': # Retrieve forecasted AQI
-                data = {
-                    "universalAqi": "true",
-                    "location": {
-                        "latitude": latitude,
-                        "longitude": longitude
-                    },
-                    "period": {
-                        "startTime": (current_dt + timedelta(hours=1)).strftime(format='%Y-%m-%dT%H:%M:%SZ'),
-                        "endTime": (current_dt + timedelta(hours=96)).strftime(format='%Y-%m-%dT%H:%M:%SZ')
-                    },
-                }
-                while True: # A while loop to handle pagination
-                    response = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
-                    for hourly_forecast in response.json()['hourlyForecasts']:
-                        aqi_results.update({hourly_forecast['dateTime']: hourly_forecast['indexes'][0]['aqi']})
-                    if 'nextPageToken' in response.json():
-                        data.update({'pageToken': response.json()['nextPageToken']})
-                    else:
-                        break
-    # Create figure object
-    figure = go.Figure()
+    for results in (forecast, current, history):
+        aqi_results.update(results)
+    return pd.DataFrame(list(aqi_results.items()), columns=['time', 'aqi']).sort_values(by='time').reset_index(drop=True)
+
+def generate_aqi_figure(current_dt, aqi_df):
+    # generate figure from the AQI history, current conditions, and forecast
+    # Split the data into history (<= now) and forecast (>= now) with vectorized datetime comparisons
+    timestamps = pd.to_datetime(aqi_df['time'], utc=True)
+    now = pd.Timestamp(current_dt)
+    history_mask = (timestamps <= now).to_numpy()
+    forecast_mask = (timestamps >= now).to_numpy()
+    x = timestamps.to_numpy(dtype='datetime64[s]')
+    aqi = aqi_df['aqi'].to_numpy()
 
     # Create the AQI line graph traces
-    figure.add_trace(go.Scatter(
-        showlegend=False,
-        name = "History",
-        x=[dt for dt in aqi_results.keys() if dt <= current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ')],
-        y=[aqi_results[dt] for dt in aqi_results.keys() if dt <= current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ')],
-        mode='lines',
-        line=dict(width=2, color='black')
-    ))
-    figure.add_trace(go.Scatter(
-        showlegend=False,
-        name = "Forecast",
-        x=[dt for dt in aqi_results.keys() if dt >= current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ')],
-        y=[aqi_results[dt] for dt in aqi_results.keys() if dt >= current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ')],
-        mode='lines',
-        line=dict(dash='dot', width=2, color='black')
-    ))
+    traces = [
+        dict(
+            type='scatter',
+            showlegend=False,
+            name = "History",
+            x=x[history_mask],
+            y=aqi[history_mask],
+            mode='lines',
+            line=dict(width=2, color='black')
+        ),
+        dict(
+            type='scatter',
+            showlegend=False,
+            name = "Forecast",
+            x=x[forecast_mask],
+            y=aqi[forecast_mask],
+            mode='lines',
+            line=dict(dash='dot', width=2, color='black')
+        ),
+    ]
 
     # Add the AQI range shapes
     aqi_ranges = [
@@ -88,21 +179,28 @@ def generate_aqi_figure(current_dt, latitude, longitude):
     {"range": [0, 50], "color": "green", "air pollution level": "Good"}
     ]
 
-    # Add shapes for each AQI range
-    for aqi_range in aqi_ranges:
-        figure.add_hrect(
+    # Add horizontal rectangles spanning the plot width for each AQI range
+    shapes = [
+        dict(
+            type = "rect",
             showlegend=True,
             name=aqi_range["air pollution level"],
             layer= 'below',
-            line_width = 0,
+            line = dict(width=0),
+            xref = "x domain",
+            x0 = 0,
+            x1 = 1,
+            yref = "y",
             y0 = aqi_range["range"][0],
             y1 = aqi_range["range"][1],
             fillcolor= aqi_range["color"],
             opacity= 0.66
         )
+        for aqi_range in aqi_ranges
+    ]
 
     # Add the "NOW" indicator
-    figure.add_shape(
+    shapes.append(dict(
         type = "line",
         x0 = current_dt,
         x1 = current_dt,
@@ -124,26 +222,25 @@ def generate_aqi_figure(current_dt, latitude, longitude):
                 family='Montserrat'
             ),
         ),
-    )
-
-    # Update X and Y axis
-    figure.update_xaxes(
-        zeroline = False,
-        minor = dict(
-            dtick = 86400000.0,
-            ticks = "inside",
-            ticklen = 5,
-            tickcolor = "black",
-        )
-    )
-    figure.update_yaxes(
-        zeroline = False,
-    )
+    ))
 
-    # Update figure layout
-    figure.update_layout(
-        xaxis=dict(tickformat='%B %-e', type = "date"),
+    # Figure layout, including X and Y axis
+    layout = dict(
+        template=_TEMPLATE,
+        shapes=shapes,
+        xaxis=dict(
+            tickformat='%B %-e',
+            type = "date",
+            zeroline = False,
+            minor = dict(
+                dtick = 86400000.0,
+                ticks = "inside",
+                ticklen = 5,
+                tickcolor = "black",
+            )
+        ),
         yaxis = dict(
+            zeroline = False,
             tickmode = "array",
             tickvals = [0, 50, 100, 150, 200, 300, 500],
             tick0 = 0,
@@ -152,21 +249,23 @@ def generate_aqi_figure(current_dt, latitude, longitude):
         legend=dict(
             itemclick=False,
             itemdoubleclick=False,
-        ),
-        legend_font=dict(
+            font=dict(
                 family='Montserrat',
                 size=13
+            ),
         ),
         font=dict(
                 size=13,
                 color="black",
                 family='Montserrat'
         ),
-        title_font=dict(
-            size=17,
-            color='black',
-            weight='bold',
-            family='Montserrat'
+        title=dict(
+            font=dict(
+                size=17,
+                color='black',
+                weight='bold',
+                family='Montserrat'
+            ),
         ),
         hovermode = "x",
         plot_bgcolor = 'white',
@@ -174,11 +273,9 @@ def generate_aqi_figure(current_dt, latitude, longitude):
         margin=dict(l=70, r=70, t=0, b=42),
     )
 
-    aqi_df = pd.DataFrame(list(aqi_results.items()), columns=['time', 'aqi'])
-    
-    return figure, aqi_df
+    return dict(data=traces, layout=layout)
 
-def generate_weather_figure(latitude, longitude):
+def fetch_weather(latitude, longitude):
 
     url = "https://api.open-meteo.com/v1/forecast"
     params = {
@@ -191,8 +288,8 @@ def generate_weather_figure(latitude, longitude):
         "forecast_days": 5
     }
 
-    response = requests.get(url, params=params)
-    response = json.loads(response.content)
+    response = _weather_session.get(url, params=params, timeout=(3, 10))
+    response = orjson.loads(response.content)
 
     # Extract current data
     current_data = {
@@ -219,67 +316,74 @@ def generate_weather_figure(latitude, longitude):
     weather_df = pd.DataFrame(combined_data)
 
     # Convert time to datetime for consistent formatting
-    weather_df["time"] = weather_df["time"].apply(lambda x: datetime.strptime(x, '%Y-%m-%dT%H:%M').strftime('%Y-%m-%dT%H:%M:%SZ'))
-    # Sort by time
-    weather_df = weather_df.sort_values(by="time").reset_index(drop=True)
+    weather_df["time"] = pd.to_datetime(weather_df["time"], format='%Y-%m-%dT%H:%M').dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    # Sort by time, stably so the current reading stays ahead of an hourly sample with the same timestamp
+    weather_df = weather_df.sort_values(by="time", kind="stable").reset_index(drop=True)
 
     current_time = response["current"]["time"]
     # Convert the datetime string to the desired format '%Y-%m-%dT%H:%M:%SZ'
     current_time = datetime.strptime(current_time, '%Y-%m-%dT%H:%M').strftime('%Y-%m-%dT%H:%M:%SZ')
 
+    return weather_df, current_time
+
+def generate_weather_figure(weather_df, current_time):
+
     # Identify the top and bottom of the temperature range before plotting
     max_temperature = max(max(weather_df['temperature_2m']), max(weather_df['apparent_temperature']))
     min_temperature = min(min(weather_df['temperature_2m']), min(weather_df['apparent_temperature']))
 
     # Split the data into historical and forecast
-    history_mask = weather_df['time'] <= current_time
-    forecast_mask = weather_df['time'] >= current_time
-
-    # Create the Dash Plotly figure
-    figure = go.Figure()
-
-    # Temperature history
-    figure.add_trace(go.Scatter(
-        showlegend=True,
-        name="Temperature History",
-        x=weather_df[history_mask]['time'],
-        y=weather_df[history_mask]['temperature_2m'],
-        mode='lines',
-        line=dict(width=2, color='black')
-    ))
+    history_mask = (weather_df['time'] <= current_time).to_numpy()
+    forecast_mask = (weather_df['time'] >= current_time).to_numpy()
+    x = pd.to_datetime(weather_df['time'], utc=True).to_numpy(dtype='datetime64[s]')
+    temperature = weather_df['temperature_2m'].to_numpy()
+    apparent_temperature = weather_df['apparent_temperature'].to_numpy()
 
-    # Temperature forecast
-    figure.add_trace(go.Scatter(
-        showlegend=True,
-        name="Temperature Forecast",
-        x=weather_df[forecast_mask]['time'],
-        y=weather_df[forecast_mask]['temperature_2m'],
-        mode='lines',
-        line=dict(dash='dot', width=2, color='black')
-    ))
-
-    # Apparent temperature history
-    figure.add_trace(go.Scatter(
-        showlegend=True,
-        name='"Feels like" History',
-        x=weather_df[history_mask]['time'],
-        y=weather_df[history_mask]['apparent_temperature'],
-        mode='lines',
-        line=dict(width=2, color='red')
-    ))
-
-    # Apparent temperature forecast
-    figure.add_trace(go.Scatter(
-        showlegend=True,
-        name='"Feels like" Forecast',
-        x=weather_df[forecast_mask]['time'],
-        y=weather_df[forecast_mask]['apparent_temperature'],
-        mode='lines',
-        line=dict(dash='dot', width=2, color='red')
-    ))
+    traces = [
+        # Temperature history
+        dict(
+            type='scatter',
+            showlegend=True,
+            name="Temperature History",
+            x=x[history_mask],
+            y=temperature[history_mask],
+            mode='lines',
+            line=dict(width=2, color='black')
+        ),
+        # Temperature forecast
+        dict(
+            type='scatter',
+            showlegend=True,
+            name="Temperature Forecast",
+            x=x[forecast_mask],
+            y=temperature[forecast_mask],
+            mode='lines',
+            line=dict(dash='dot', width=2, color='black')
+        ),
+        # Apparent temperature history
+        dict(
+            type='scatter',
+            showlegend=True,
+            name='"Feels like" History',
+            x=x[history_mask],
+            y=apparent_temperature[history_mask],
+            mode='lines',
+            line=dict(width=2, color='red')
+        ),
+        # Apparent temperature forecast
+        dict(
+            type='scatter',
+            showlegend=True,
+            name='"Feels like" Forecast',
+            x=x[forecast_mask],
+            y=apparent_temperature[forecast_mask],
+            mode='lines',
+            line=dict(dash='dot', width=2, color='red')
+        ),
+    ]
 
-# Add the "NOW" indicator
-    figure.add_shape(
+    # Add the "NOW" indicator
+    shapes = [dict(
         type = "line",
         x0 = current_time,
         x1 = current_time,
@@ -301,49 +405,52 @@ def generate_weather_figure(latitude, longitude):
                 family='Montserrat'
             ),
         ),
-    )
-
-    # Update X and Y axis
-    figure.update_xaxes(
-        zeroline = False,
-        minor = dict(
-            dtick = 86400000.0,
-            ticks = "inside",
-            ticklen = 5,
-            tickcolor = "black",
-        )
-    )
-    figure.update_yaxes(
-        zeroline = False,
-        range=[min_temperature, max_temperature],
-        tickmode='auto',
-        ticks='outside',
-        ticklen=5,
-        tickcolor='black',
-    )
+    )]
 
-    # Update figure layout
-    figure.update_layout(
-        xaxis=dict(tickformat='%B %-e', type = "date"),
+    # Figure layout, including X and Y axis
+    layout = dict(
+        template=_TEMPLATE,
+        shapes=shapes,
+        xaxis=dict(
+            tickformat='%B %-e',
+            type = "date",
+            zeroline = False,
+            minor = dict(
+                dtick = 86400000.0,
+                ticks = "inside",
+                ticklen = 5,
+                tickcolor = "black",
+            )
+        ),
+        yaxis=dict(
+            zeroline = False,
+            range=[min_temperature, max_temperature],
+            tickmode='auto',
+            ticks='outside',
+            ticklen=5,
+            tickcolor='black',
+        ),
         showlegend=True,
         legend=dict(
             itemclick=False,
             itemdoubleclick=False,
-        ),
-        legend_font=dict(
+            font=dict(
                 family='Montserrat',
                 size=13
+            ),
         ),
         font=dict(
                 size=13,
                 color="black",
                 family='Montserrat'
         ),
-        title_font=dict(
-            size=17,
-            color='black',
-            weight='bold',
-            family='Montserrat'
+        title=dict(
+            font=dict(
+                size=17,
+                color='black',
+                weight='bold',
+                family='Montserrat'
+            ),
         ),
         hovermode = "x",
         plot_bgcolor = '#F1F1F1',
@@ -351,4 +458,4 @@ def generate_weather_figure(latitude, longitude):
         margin=dict(l=70, r=70, t=0, b=42),
     )
     
-    return figure, weather_df
\ No newline at end of file
+    return dict(data=traces, layout=layout)
\ No newline at end of file
@@ -2,15 +2,20 @@
 import dash
 from dash import html, dcc, callback, Input, Output, get_app
 from dash.exceptions import PreventUpdate
-from utils import get_smart, generate_iframe, generate_prompt, generate_clinical_details_table, get_patient_demographics, fetch_all_resources
-from figures import generate_aqi_figure, generate_weather_figure
-from fhirclient.models.patient import Patient
-from fhirclient.models.condition import Condition
+from utils import get_smart, run_async, generate_iframe, generate_prompt, generate_clinical_details_table, get_patient_demographics, fetch_all_resources, fetch_patient_and_conditions, summarize_condition
+from figures import fetch_aqi, fetch_weather, generate_aqi_figure, generate_weather_figure
 from fhirclient.models.encounter import Encounter
 from fhirclient.models.medicationadministration import MedicationAdministration
 import googlemaps
 from datetime import datetime, timezone
 import os
+import logging
+import concurrent.futures
+import threading
+import hashlib
+import json
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 import google.generativeai as genai
 import pandas as pd
 
@@ -19,6 +24,36 @@ import pandas as pd
 dash.register_page(__name__, path='/visualization')
 app = get_app()
 
+# API keys are read and clients are configured once at import time rather than on every page load
+_MAPS_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
+_GEMINI_KEY = os.getenv('GOOGLE_GEMINI_API_KEY')
+_GEMINI_MODEL_NAME = os.getenv('GOOGLE_GEMINI_MODEL')
+genai.configure(api_key=_GEMINI_KEY)
+_GEMINI_MODEL = genai.GenerativeModel(_GEMINI_MODEL_NAME)
+_GMAPS = googlemaps.Client(key=_MAPS_KEY)
+
+# Shared pool for the blocking I/O in the callback (FHIR reads, geocoding, weather), kept warm between page loads
+_IO_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='viz-io')
+
+# Patient addresses rarely change, so geocoding results are cached for a day keyed on the normalized address
+@cached(TTLCache(maxsize=4096, ttl=86400), key=lambda address: hashkey(' '.join(address.lower().split())), lock=threading.Lock())
+def _geocode(address):
+    geocode_result = _GMAPS.geocode(address)
+    location = geocode_result[0]['geometry']['location']
+    return location['lat'], location['lng']
+
+# The same patient records and environmental data yield the same consultation, so Gemini responses are cached for an hour.
+# The cache is only touched from the shared event loop, so it needs no lock.
+_consultation_cache = TTLCache(maxsize=2048, ttl=3600)
+
+async def _generate_consultation(cache_key, prompt):
+    consultation = _consultation_cache.get(cache_key)
+    if consultation is None:
+        response = await _GEMINI_MODEL.generate_content_async(prompt)
+        consultation = response.text
+        _consultation_cache[cache_key] = consultation
+    return consultation
+
 # Define the layout
 layout = html.Div(id='appcontainer', children=[
     dcc.Location(id='url'),
@@ -71,52 +106,55 @@ layout = html.Div(id='appcontainer', children=[
 )
 def handle_callback(href):
     smart = get_smart()
-    # Retrieve FHIR resources
-    patient = Patient.read(rem_id=smart.patient_id, server=smart.server)
-    conditions = fetch_all_resources(Condition, smart)
-    medication_administrations = fetch_all_resources(MedicationAdministration, smart)
-    encounters = fetch_all_resources(Encounter, smart)
+    # Retrieve FHIR resources concurrently, with the patient and their conditions batched into one request
+    patient_and_conditions_future = _IO_POOL.submit(fetch_patient_and_conditions, smart)
+    medication_administrations_future = _IO_POOL.submit(fetch_all_resources, MedicationAdministration, smart)
+    encounters_future = _IO_POOL.submit(fetch_all_resources, Encounter, smart)
+    patient, conditions = patient_and_conditions_future.result()
     # Check if address is not null
     if not (hasattr(patient, 'address') and len(patient.address) != 0):
         raise PreventUpdate("No address found for the patient.")
     # Get patient demographics
     try:
         name, sex, birthday, address = get_patient_demographics(patient)
-        app.logger.debug(f'Patient demographics:\n{name, sex, birthday, address}')
+        app.logger.debug('Patient demographics:\n%s', (name, sex, birthday, address))
     except Exception as e:
         app.logger.error("An error occurred while parsing the patient's demographics", exc_info=True)
         raise PreventUpdate("Something went wrong processing the patient's demographics")
+
+    # Retrieve latitude + longitude of patient's address while the remaining health records load
+    geocode_future = _IO_POOL.submit(_geocode, address)
+
+    medication_administrations = medication_administrations_future.result()
+    encounters = encounters_future.result()
     # Generate UI tables
     try:
         conditions_table, encounters_table, medication_administrations_table = generate_clinical_details_table(conditions, encounters, medication_administrations)
-        # Convert FHIR resources retrieved to JSON serializable lists
-        conditions = [condition.as_json() for condition in conditions]
+        # Convert FHIR resources retrieved to JSON serializable lists, keeping only the condition fields the prompt needs
+        conditions = [summarize_condition(condition) for condition in conditions]
         encounters = [encounter.as_json() for encounter in encounters]
         medication_administrations = [medication_administration.as_json() for medication_administration in medication_administrations]
     except Exception as e:
         app.logger.error("An error occurred while parsing the patient's FHIR resources", exc_info=True)
         raise PreventUpdate("Something went wrong processing the patient's health records")
 
-    # Retrieve latitude + longitude of patient's address / retrieve embeddable google maps iFrame
-    gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
-    # Geocoding an address
-    geocode_result = gmaps.geocode(address)
-    latitude = geocode_result[0]['geometry']['location']['lat']
-    longitude = geocode_result[0]['geometry']['location']['lng']
+    latitude, longitude = geocode_future.result()
     # Get iFrame
     maps_iframe = generate_iframe(address)
 
-    # Generate environmental data and figures
+    # Retrieve AQI and weather data concurrently
     current_dt = datetime.now(timezone.utc)
-    aqi_figure, aqi_results = generate_aqi_figure(current_dt, latitude, longitude)
-    weather_figure, weather_results = generate_weather_figure(latitude, longitude)
-    combined_environmental_data = pd.merge(aqi_results, weather_results, on='time', how='outer')
+    aqi_future = run_async(fetch_aqi(current_dt, latitude, longitude))
+    weather_future = _IO_POOL.submit(fetch_weather, latitude, longitude)
+    aqi_df = aqi_future.result()
+    weather_df, current_time = weather_future.result()
+    combined_environmental_data = pd.merge(aqi_df, weather_df, on='time', how='outer')
+    # Render every row of the environmental table, both in the debug log (only when enabled) and in the prompt
     pd.set_option('display.max_rows', None)
-    print(f"Combined env data\n{combined_environmental_data}")
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug(f"Combined env data\n{combined_environmental_data}")
 
     # Ask google gemini to make a recommendation for the patient, given their age, sex, health records, and AQI forecast.
-    genai.configure(api_key=os.getenv('GOOGLE_GEMINI_API_KEY'))
-    model = genai.GenerativeModel(os.getenv('GOOGLE_GEMINI_MODEL'))
     prompt = generate_prompt(
         patient.gender,
         patient.birthDate.isostring,
@@ -126,7 +164,23 @@ def handle_callback(href):
         current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ'),
         combined_environmental_data
     )
-    gemini_response = model.generate_content(prompt)
+    # Key the consultation on its inputs, with readings rounded and the time truncated to the hour so refreshes hit the cache.
+    # The current weather reading is left out because its timestamp moves in 15 minute steps; it is the first row at current_time.
+    hourly_weather_df = weather_df.drop(index=weather_df.index[weather_df['time'] == current_time][0])
+    consultation_key = hashlib.blake2b('|'.join([
+        str(patient.gender),
+        str(patient.birthDate.isostring),
+        json.dumps([conditions, encounters, medication_administrations], sort_keys=True),
+        current_dt.strftime(format='%Y-%m-%dT%H'),
+        aqi_df.to_csv(index=False),
+        hourly_weather_df.round().to_csv(index=False),
+    ]).encode(), digest_size=16).hexdigest()
+    gemini_future = run_async(_generate_consultation(consultation_key, prompt))
+
+    # Generate figures while gemini is responding
+    aqi_figure = generate_aqi_figure(current_dt, aqi_df)
+    weather_figure = generate_weather_figure(weather_df, current_time)
+    consultation = gemini_future.result()
 
     # Render the patient's details, records, detected address, and AQI visualization
     return (
@@ -139,7 +193,7 @@ def handle_callback(href):
         medication_administrations_table,
         f"📍 {address}",
         maps_iframe,
-        gemini_response.text,
+        consultation,
         aqi_figure,
         weather_figure
     )
\ No newline at end of file
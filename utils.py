@@ -4,6 +4,9 @@ from fhirclient.models.condition import Condition
 from fhirclient.models.bundle import Bundle
 import os
 import urllib.parse
+import asyncio
+import threading
+from operator import itemgetter
 from dash import dash_table
 
 # SMART on FHIR configuration
@@ -21,6 +24,17 @@ def reset():
     if 'state' in session:
         del session['state']
 
+# Long-lived event loop shared by every callback, so pooled async HTTP sessions survive between page loads
+_event_loop = asyncio.new_event_loop()
+threading.Thread(target=_event_loop.run_forever, name='async-io', daemon=True).start()
+
+def run_async(coroutine):
+    """
+    Schedule a coroutine on the shared event loop and return a
+    concurrent.futures.Future for its result
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop)
+
 # Function to get FHIR client
 def get_smart():
     state = session.get('state')
@@ -29,6 +43,41 @@ def get_smart():
     else:
         return client.FHIRClient(settings=app_settings, save_func=save_state)
 
+def get_condition_name(condition):
+    condition_name = ''
+    if hasattr(condition, 'code'):
+        if hasattr(condition.code, 'text'):
+            condition_name = condition.code.text
+        elif hasattr(condition.code, 'coding'):
+            for coding in condition.code.coding:
+                if hasattr(coding, 'display'):
+                    condition_name = coding.display
+                    break
+        else:
+            raise Exception("A Condition resource has no 'code' element")
+    return condition_name
+
+def get_status_code(status):
+    # Read a clinical/verification status CodeableConcept, preferring its code over its text
+    status_code = 'Unknown'
+    if hasattr(status, 'text'):
+        status_code = status.text
+    if hasattr(status, 'coding'):
+        status_code = status.coding[0].code
+    return status_code
+
+def summarize_condition(condition):
+    """
+    A function for projecting a FHIR Condition onto the few fields the
+    Gemini prompt needs, rather than serializing the whole resource
+    """
+    return {
+        'name': get_condition_name(condition),
+        'clinical_status': get_status_code(condition.clinicalStatus),
+        'verification_status': get_status_code(condition.verificationStatus),
+        'onset': condition.onsetDateTime.isostring if condition.onsetDateTime else None,
+    }
+
 def generate_clinical_details_table(conditions, encounters, medication_administrations):
     """
     A function for processing a list of FHIR resource objects and arranging
@@ -40,41 +89,14 @@ def generate_clinical_details_table(conditions, encounters, medication_administr
 
     # Iterate through each condition and collect the necessary details
     for condition in conditions:
-            
-        condition_name = ''
-        if hasattr(condition, 'code'):
-            if hasattr(condition.code, 'text'):
-                condition_name = condition.code.text
-            elif hasattr(condition.code, 'coding'):
-                for coding in condition.code.coding:
-                    if hasattr(coding, 'display'):
-                        condition_name = coding.display
-                        break
-            else:
-                raise Exception("A Condition resource has no 'code' element")
-
-        clinical_status = 'Unknown'
-        if hasattr(condition, 'clinicalStatus'):
-            if hasattr(condition.clinicalStatus, 'text'):
-                clinical_status = condition.clinicalStatus.text
-            if hasattr(condition.clinicalStatus, 'coding'):
-                clinical_status = condition.clinicalStatus.coding[0].code
-
-        verification_status = 'Unknown'
-        if hasattr(condition, 'verificationStatus'):
-            if hasattr(condition.verificationStatus, 'text'):
-                verification_status = condition.verificationStatus.text
-            if hasattr(condition.verificationStatus, 'coding'):
-                verification_status = condition.verificationStatus.coding[0].code
-
         health_conditions_list.append({
-            'condition_name': condition_name,
-            'clinical_status': clinical_status,
-            'verification_status': verification_status,
+            'condition_name': get_condition_name(condition),
+            'clinical_status': get_status_code(condition.clinicalStatus),
+            'verification_status': get_status_code(condition.verificationStatus),
         })
 
     # Sort conditions by status
-    health_conditions_list.sort(key=lambda x: x['clinical_status'])
+    health_conditions_list.sort(key=itemgetter('clinical_status'))
 
     # Create Conditions Dash table
     conditions_table = dash_table.DataTable(
@@ -142,7 +164,7 @@ def generate_clinical_details_table(conditions, encounters, medication_administr
         })
 
     # Sort encounters by status
-    encounters_list.sort(key=lambda x: x['encounter_status'])
+    encounters_list.sort(key=itemgetter('encounter_status'))
     # Create Encounters Dash table
     encounters_table = dash_table.DataTable(
         id='encounters-table',
@@ -199,7 +221,7 @@ def generate_clinical_details_table(conditions, encounters, medication_administr
         })
 
     # Sort medication administrations by status
-    medication_administrations_list.sort(key=lambda x: x['medication_administration_status'])
+    medication_administrations_list.sort(key=itemgetter('medication_administration_status'))
 
     # Create Medication Administration Dash table
     medication_administrations_table = dash_table.DataTable(
@@ -261,17 +283,8 @@ def generate_iframe(address):
 
 def get_patient_demographics(patient):
     # Selecting the official name or first available name
-    name = None
-    for name in patient.name:
-        # Check if the name has the "official" use code
-        if "official" in name.use:
-            firstNames = " ".join(name.given)
-            name = name.text if name.text is not None else firstNames + " " + name.family
-            break  # If found, no need to check further
-    # if no "official" name found, use the first one available
-    if not name:
-        firstNames = " ".join(patient.name[0].given)
-        name = patient.name[0].text if patient.name[0].text is not None else firstNames + " " + patient.name[0].family
+    official = next((n for n in patient.name if 'official' in (n.use or '')), patient.name[0])
+    name = official.text or ' '.join(filter(None, [' '.join(official.given or []), official.family]))
 
     # Sex (called gender in FHIR R4)
     sex = patient.gender if patient.gender else "Unknown"
@@ -295,12 +308,12 @@ def get_patient_demographics(patient):
             address = address.text
         else:
             # If 'text' property isn't present or is empty, concatenate address fields
-            lines = address.line if hasattr(address, 'line') else []
-            city = address.city if (address, 'city') else ''
-            district = address.district if (address, 'district') else ''
-            state = address.state if (address, 'state') else ''
-            postal_code = address.postalCode if (address, 'postalCode') else ''
-            country = address.country if (address, 'country') else ''
+            lines = getattr(address, 'line', None) or []
+            city = getattr(address, 'city', '') or ''
+            district = getattr(address, 'district', '') or ''
+            state = getattr(address, 'state', '') or ''
+            postal_code = getattr(address, 'postalCode', '') or ''
+            country = getattr(address, 'country', '') or ''
             address = ', '.join(filter(None, [', '.join(lines), city, district, state, postal_code, country]))
     elif len(patient.address) > 1:
         raise Exception("Multiple addresses detected!")
@@ -339,15 +352,52 @@ def get_patient_demographics(patient):
     """
     return (name, sex, birthday, address)
 
-def fetch_all_resources(resource_class, smart):
+def collect_bundle_resources(bundle, smart):
     resources = []
-    next_url = resource_class.where(struct={'patient': smart.patient_id}).perform(smart.server)
-    
-    while next_url:
-        if next_url.entry:
-            resources.extend(entry.resource for entry in next_url.entry)
+    while bundle:
+        if bundle.entry:
+            resources.extend(entry.resource for entry in bundle.entry)
         
-        next_link = next((link.url for link in next_url.link if link.relation == 'next'), None)
-        next_url = Bundle.read_from(next_link, smart.server) if next_link else None
+        next_link = next((link.url for link in bundle.link or [] if link.relation == 'next'), None)
+        bundle = Bundle.read_from(next_link, smart.server) if next_link else None
 
     return resources
+
+# Large page size so typical patient record searches complete in one round-trip instead of following 'next' links
+SEARCH_PAGE_SIZE = '1000'
+
+def fetch_all_resources(resource_class, smart):
+    return collect_bundle_resources(resource_class.where(struct={'patient': smart.patient_id, '_count': SEARCH_PAGE_SIZE}).perform(smart.server), smart)
+
+def fetch_patient_and_conditions(smart):
+    """
+    A function for retrieving the patient and their current conditions in a
+    single round-trip by POSTing a FHIR batch Bundle to the server. Any
+    further pages of conditions are followed from the nested searchset Bundle
+    """
+    # Intentionally narrows the Conditions tab and the prompt to current conditions (active, recurrence, or relapse).
+    # Unverified conditions are kept, since verificationStatus is optional; only refuted and entered-in-error ones
+    # are excluded (':not' also matches conditions without a verificationStatus). Results are trimmed to the
+    # elements the app reads.
+    condition_search = [
+        ('patient', smart.patient_id),
+        ('clinical-status', 'active,recurrence,relapse'),
+        ('verification-status:not', 'refuted'),
+        ('verification-status:not', 'entered-in-error'),
+        ('_elements', 'subject,code,clinicalStatus,verificationStatus,onset'),
+        ('_count', SEARCH_PAGE_SIZE),
+    ]
+    batch = {
+        'resourceType': 'Bundle',
+        'type': 'batch',
+        'entry': [
+            {'request': {'method': 'GET', 'url': f'Patient/{smart.patient_id}'}},
+            {'request': {'method': 'GET', 'url': f'Condition?{urllib.parse.urlencode(condition_search, safe=",:")}'}},
+        ]
+    }
+    response = Bundle(smart.server.post_json('', batch).json())
+    for entry in response.entry:
+        if not (entry.response and entry.response.status.startswith('2')):
+            raise Exception(f"A batch request failed with status '{entry.response.status if entry.response else 'Unknown'}'")
+    patient_entry, conditions_entry = response.entry
+    return patient_entry.resource, collect_bundle_resources(conditions_entry.resource, smart)
\ No newline at end of file